@@ -265,10 +265,13 @@ function! s:call(cmd, cb, nocoq, args) abort
     return [0, -1]
   endif
 
+  " N.B. Send 'changedtick' along so Python doesn't need to query it. The
+  " buffer is unmodifiable while commands are pending so it can't go stale.
   let a:args.opts = {
     \ 'encoding': &encoding,
     \ 'timeout': coqtail#panels#getvar('coqtail_timeout'),
-    \ 'filename': expand('#' . b:coqtail_panel_bufs.main . ':p')
+    \ 'filename': expand('#' . b:coqtail_panel_bufs.main . ':p'),
+    \ 'changedtick': getbufvar(b:coqtail_panel_bufs.main, 'changedtick')
   \}
   let l:args = [b:coqtail_panel_bufs.main, a:cmd, a:args]
 
@@ -9,12 +9,10 @@ import re
 import socket
 import threading
 import time
-from collections import defaultdict as ddict
+from bisect import bisect_left
 from collections import deque
-from itertools import islice
 
-from six import indexbytes, iterbytes, string_types
-from six.moves import zip_longest
+from six import string_types
 from six.moves.queue import Empty, Queue
 from six.moves.socketserver import StreamRequestHandler, ThreadingTCPServer
 
@@ -23,16 +21,16 @@ import coqtop as CT
 # For Mypy
 try:
     from typing import (
+        IO,
         Any,
         Callable,
-        DefaultDict,
         Deque,
         Dict,
         Iterable,
-        Iterator,
         List,
         Mapping,
         Optional,
+        Pattern,
         Sequence,
         Text,
         Tuple,
@@ -41,6 +39,15 @@ try:
 except ImportError:
     pass
 
+# N.B. orjson is optional, but its encoder and decoder are much faster than
+# json's when it is available
+try:
+    import orjson  # type: ignore[import-not-found, unused-ignore]
+
+    _HAS_ORJSON = True
+except ImportError:
+    _HAS_ORJSON = False
+
 
 def lines_and_highlights(tagged_tokens, line_no):
     # type: (Union[Text, Iterable[Tuple[Text, Optional[Text]]]], int) -> Tuple[List[Text], List[Tuple[int, int, int, Text]]]
@@ -57,26 +64,30 @@ def lines_and_highlights(tagged_tokens, line_no):
     lines = []  # type: List[Text]
     highlights = []  # type: List[Tuple[int, int, int, Text]]
     line_no += 1  # Convert to 1-indexed per matchaddpos()'s spec
-    line, index = u"", 1
+    line, index = [], 1  # type: List[Text], int
 
     for token, tag in tagged_tokens:
         # NOTE: Can't use splitlines or else tokens like ' =\n' won't properly
         # begin a new line
-        for i, tok in enumerate(token.split("\n")):
+        toks = token.split("\n")
+        # Encode the whole token once instead of each piece separately.
+        # N.B. '\n' can't appear inside a multibyte UTF-8 character so the
+        # pieces line up.
+        tok_lens = [len(tok) for tok in token.encode("utf-8").split(b"\n")]
+        for i, (tok, tok_len) in enumerate(zip(toks, tok_lens)):
             if i > 0:
                 # Encountered a newline in token
-                lines.append(line)
+                lines.append(u"".join(line))
                 line_no += 1
-                line, index = "", 1
+                line, index = [], 1
 
-            tok_len = len(tok.encode("utf-8"))
             if tag is not None:
                 highlights.append((line_no, index, tok_len, tag))
 
-            line += tok
+            line.append(tok)
             index += tok_len
 
-    lines.append(line)
+    lines.append(u"".join(line))
     return lines, highlights
 
 
@@ -94,6 +105,41 @@ class NoDotError(Exception):
     """No more sentences were found."""
 
 
+# Patterns for parsing query responses
+_INDENT_JOIN_RE = re.compile(r"\n +")
+_ALIAS_RE = re.compile(r"\(alias of (.*)\)")
+_LIB_FILE_RE = re.compile(r"file\s+(.*)\.vo")
+_BULLET_RE = re.compile(r'(?:bullet |unfocusing with ")([-+*}]+)')
+# Sentences that can change which libraries 'Locate Library' finds
+_LIB_CMD_RE = re.compile(b"\\s*(?:From|Require|Load|Add)\\b")
+
+# Patterns for finding sentences
+_DOT_RE = re.compile(b'\\(\\*|"|\\.\\.\\.|\\.\\.|\\.')
+_SELECTOR_RE = re.compile(b"\\d+\\s*:\\s*\\{")
+_COMMENT_RE = re.compile(b"\\(\\*|\\*\\)")
+
+# Coqtail logo for the splash screen
+_SPLASH = (
+    u"~~~~~~~~~~~~~~~~~~~~~~~",
+    u"λ                     /",
+    u" λ      Coqtail      / ",
+    u"  λ                 /  ",
+    u"   λ{}/    ",
+    u"    λ             /    ",
+    u"     λ           /     ",
+    u"      λ         /      ",
+    u"       λ       /       ",
+    u"        λ     /        ",
+    u"         λ   /         ",
+    u"          λ /          ",
+    u"           ‖           ",
+    u"           ‖           ",
+    u"           ‖           ",
+    u"          / λ          ",
+    u"         /___λ         ",
+)
+
+
 # Coqtail Server #
 class Coqtail(object):
     """Manage Coqtop interfaces and auxiliary buffers for each Coq file."""
@@ -105,12 +151,19 @@ class Coqtail(object):
         coqtop - The Coqtop interface
         handler - The Vim interface
         oldchange - The previous number of changes to the buffer
-        oldbuf - The buffer corresponding to oldchange
+        oldbuf - The buffer corresponding to oldchange (at least up to the end
+                 of the checked region)
+        oldbuf_full - Whether oldbuf contains the entire buffer
         endpoints - A stack of the end positions of the sentences sent to Coqtop
                     (grows to the right)
         send_queue - A queue of the sentences to send to Coqtop
+        sentences - The sentences found in the buffer at oldchange, keyed by
+                    their start position
+        qual_names - Cached results of qual_name for the current Coqtop state
+        libs - Cached results of find_lib for the current Coqtop state
         error_at - The position of the last error
         info_msg - Lines of text to display in the info panel
+        goals - The goals that goal_msg was printed from
         goal_msg - Lines of text to display in the goal panel
         goal_hls - Highlight positions for each line of goal_msg
         """
@@ -118,10 +171,19 @@ class Coqtail(object):
         self.handler = handler
         self.oldchange = 0
         self.oldbuf = []  # type: Sequence[bytes]
+        self.oldbuf_full = False
         self.endpoints = []  # type: List[Tuple[int, int]]
         self.send_queue = deque()  # type: Deque[Mapping[str, Tuple[int, int]]]
+        self.sentences = (
+            {}
+        )  # type: Dict[Tuple[int, int], Mapping[str, Tuple[int, int]]]
+        self.qual_names = {}  # type: Dict[Text, Optional[Tuple[Text, Text]]]
+        self.libs = {}  # type: Dict[Text, Optional[Text]]
         self.error_at = None  # type: Optional[Tuple[Tuple[int, int], Tuple[int, int]]]
         self.info_msg = []  # type: List[Text]
+        self.goals = (
+            None
+        )  # type: Optional[Tuple[List[Any], List[Any], List[Any], List[Any]]]
         self.goal_msg = []  # type: List[Text]
         self.goal_hls = []  # type: List[Tuple[int, int, int, Text]]
 
@@ -129,12 +191,14 @@ class Coqtail(object):
         # type: (Mapping[str, Any]) -> Optional[Text]
         """Check if the buffer has been updated and rewind Coqtop if so."""
         err = None
-        newchange = self.changedtick
+        newchange = opts["changedtick"]
         if newchange != self.oldchange:
-            newbuf = self.buffer
+            newbuf = []  # type: Sequence[bytes]
 
-            if self.endpoints != []:
+            if self.endpoints:
                 eline, ecol = self.endpoints[-1]
+                # Only changes in the checked region require rewinding
+                newbuf = self.buffer_lines(0, eline + 1)
                 linediff = _find_diff(self.oldbuf, newbuf, eline + 1)
                 if linediff is not None:
                     try:
@@ -151,6 +215,8 @@ class Coqtail(object):
 
             self.oldchange = newchange
             self.oldbuf = newbuf
+            self.oldbuf_full = False
+            self.sentences.clear()
 
         return err
 
@@ -159,6 +225,8 @@ class Coqtail(object):
         # type: (str, str, str, List[str], Mapping[str, Any]) -> Optional[Text]
         """Start a new Coqtop instance."""
         errmsg = []  # type: List[Text]
+        self.qual_names.clear()
+        self.libs.clear()
 
         try:
             err, stderr = self.coqtop.start(
@@ -183,6 +251,8 @@ class Coqtail(object):
         # type: (Mapping[str, Any]) -> None
         """Stop Coqtop."""
         self.coqtop.stop()
+        self.qual_names.clear()
+        self.libs.clear()
 
     def step(self, steps, opts):
         # type: (int, Mapping[str, Any]) -> Optional[str]
@@ -193,13 +263,13 @@ class Coqtail(object):
             return None
 
         # Get the location of the last '.'
-        line, col = self.endpoints[-1] if self.endpoints != [] else (0, 0)
+        line, col = self.endpoints[-1] if self.endpoints else (0, 0)
 
         unmatched = None
         buffer = self.buffer
         for _ in range(steps):
             try:
-                to_send = _get_message_range(buffer, (line, col))
+                to_send = self.next_sentence(buffer, (line, col))
             except UnmatchedError as e:
                 unmatched = e
                 break
@@ -221,7 +291,7 @@ class Coqtail(object):
     def rewind(self, steps, opts):
         # type: (int, Mapping[str, Any]) -> Optional[Text]
         """Rewind Coq by 'steps' sentences."""
-        if steps < 1 or self.endpoints == []:
+        if steps < 1 or not self.endpoints:
             return None
 
         try:
@@ -233,8 +303,10 @@ class Coqtail(object):
         if extra_steps is None:
             return msg
 
-        self.endpoints = self.endpoints[: -(steps + extra_steps)]
+        del self.endpoints[-(steps + extra_steps) :]
         self.error_at = None
+        self.qual_names.clear()
+        self.libs.clear()
         self.refresh(opts=opts)
         return None
 
@@ -244,7 +316,7 @@ class Coqtail(object):
         self.sync(opts=opts)
 
         # Get the location of the last '.'
-        eline, ecol = self.endpoints[-1] if self.endpoints != [] else (0, 0)
+        eline, ecol = self.endpoints[-1] if self.endpoints else (0, 0)
 
         # Check if should rewind or advance
         if (line, col) < (eline, ecol):
@@ -254,7 +326,7 @@ class Coqtail(object):
             buffer = self.buffer
             while True:
                 try:
-                    to_send = _get_message_range(buffer, (eline, ecol))
+                    to_send = self.next_sentence(buffer, (eline, ecol))
                 except UnmatchedError as e:
                     # Only report unmatched if it occurs after the desired position
                     if e.range[0] <= (line, col):
@@ -296,10 +368,21 @@ class Coqtail(object):
         # type: (Mapping[str, Any]) -> Tuple[int, int]
         """Return the end of the Coq checked section."""
         # Get the location of the last '.'
-        line, col = self.endpoints[-1] if self.endpoints != [] else (0, 1)
+        line, col = self.endpoints[-1] if self.endpoints else (0, 1)
         return (line + 1, col)
 
     # Helpers #
+    def next_sentence(self, buffer, after):
+        # type: (Sequence[bytes], Tuple[int, int]) -> Mapping[str, Tuple[int, int]]
+        """Find the next sentence after a given point, reusing earlier results
+        if the buffer hasn't changed.
+        """
+        try:
+            return self.sentences[after]
+        except KeyError:
+            to_send = self.sentences[after] = _get_message_range(buffer, after)
+            return to_send
+
     def send_until_fail(self, buffer, opts):
         # type: (Sequence[bytes], Mapping[str, Any]) -> Tuple[Optional[Tuple[int, int]], Optional[str]]
         """Send all sentences in 'send_queue' until an error is encountered."""
@@ -332,6 +415,10 @@ class Coqtail(object):
             if success:
                 line, col = to_send["stop"]
                 self.endpoints.append((line, col + 1))
+                # New definitions may shadow old ones
+                self.qual_names.clear()
+                if _LIB_CMD_RE.match(no_comments):
+                    self.libs.clear()
             else:
                 self.send_queue.clear()
                 failed_at = to_send["start"]
@@ -358,7 +445,8 @@ class Coqtail(object):
         # type: (int, int, Mapping[str, Any]) -> Optional[Text]
         """Rewind to a specific location."""
         # Count the number of endpoints after the specified location
-        steps_too_far = sum(pos >= (line, col) for pos in self.endpoints)
+        # N.B. 'endpoints' is sorted because sentences are checked in order
+        steps_too_far = len(self.endpoints) - bisect_left(self.endpoints, (line, col))
         return self.rewind(steps_too_far, opts=opts)
 
     def do_query(self, query, opts):
@@ -382,27 +470,45 @@ class Coqtail(object):
 
     def qual_name(self, target, opts):
         # type: (Text, Mapping[str, Any]) -> Optional[Tuple[Text, Text]]
-        """Find the fully qualified name of 'target' using 'Locate'."""
+        """Find the fully qualified name of 'target', or use the cached result."""
+        try:
+            return self.qual_names[target]
+        except KeyError:
+            pass
+
+        # N.B. Only cache answers from Coqtop so a timeout or interrupt is
+        # retried next time
+        success, qual = self.locate(target, opts=opts)
+        if success:
+            self.qual_names[target] = qual
+        return qual
+
+    def locate(self, target, opts):
+        # type: (Text, Mapping[str, Any]) -> Tuple[bool, Optional[Tuple[Text, Text]]]
+        """Find the fully qualified name of 'target' using 'Locate'.
+
+        Also return whether the query succeeded.
+        """
         success, locate, _ = self.do_query("Locate {}.".format(target), opts=opts)
         if not success:
-            return None
+            return False, None
 
         # Join lines that start with whitespace to the previous line
-        locate = re.sub(r"\n +", " ", locate)
+        locate = _INDENT_JOIN_RE.sub(" ", locate)
 
         # Choose first match from 'Locate' since that is the default in the
         # current context
-        match = locate.split("\n")[0]
+        match = locate.partition("\n")[0]
         if "No object of basename" in match:
-            return None
+            return True, None
         else:
             # Look for alias
-            alias = re.search(r"\(alias of (.*)\)", match)
+            alias = _ALIAS_RE.search(match)
             if alias is not None:
                 # Found an alias, search again using that
-                return self.qual_name(alias.group(1), opts=opts)
+                return self.locate(alias.group(1), opts=opts)
 
-            info = match.split()
+            info = match.split(None, 3)
             # Special case for Module Type
             if info[0] == "Module" and info[1] == "Type":
                 tgt_type = "Module Type"  # type: Text
@@ -410,17 +516,24 @@ class Coqtail(object):
             else:
                 tgt_type, qual_tgt = info[:2]
 
-        return qual_tgt, tgt_type
+        return True, (qual_tgt, tgt_type)
 
     def find_lib(self, lib, opts):
         # type: (Text, Mapping[str, Any]) -> Optional[Text]
         """Find the path to the .v file corresponding to the libary 'lib'."""
+        try:
+            return self.libs[lib]
+        except KeyError:
+            pass
+
         success, locate, _ = self.do_query("Locate Library {}.".format(lib), opts=opts)
         if not success:
+            # N.B. Don't cache failed queries so they are retried next time
             return None
 
-        path = re.search(r"file\s+(.*)\.vo", locate)
-        return path.group(1) if path is not None else None
+        match = _LIB_FILE_RE.search(locate)
+        path = self.libs[lib] = match.group(1) if match is not None else None
+        return path
 
     def find_qual(self, qual_tgt, tgt_type, opts):
         # type: (Text, Text, Mapping[str, Any]) -> Optional[Tuple[Text, Text]]
@@ -466,7 +579,7 @@ class Coqtail(object):
         if not success:
             return None
 
-        bmatch = re.search(r'(?:bullet |unfocusing with ")([-+*}]+)', show)
+        bmatch = _BULLET_RE.search(show)
         return bmatch.group(1) if bmatch is not None else None
 
     # Goals and Infos #
@@ -478,9 +591,13 @@ class Coqtail(object):
             if newinfo != "":
                 self.set_info(newinfo, reset=False)
             if newgoals is not None:
-                self.set_goal(self.pp_goals(newgoals, opts=opts))
+                # N.B. When a subgoal is finished the expected bullet depends
+                # on more than just the goals, so always re-print
+                if newgoals != self.goals or newgoals[0] == []:
+                    self.set_goal(self.pp_goals(newgoals, opts=opts))
             else:
                 self.set_goal(clear=True)
+            self.goals = newgoals
         self.handler.refresh(goals=goals, force=force, scroll=scroll)
 
     def get_goals(self, opts):
@@ -499,10 +616,9 @@ class Coqtail(object):
         lines = []  # type: List[Text]
         highlights = []  # type: List[Tuple[int, int, int, Text]]
         fg, bg, shelved, given_up = goals
-        bg_joined = [pre + post for pre, post in bg]
 
         ngoals = len(fg)
-        nhidden = len(bg_joined[0]) if bg_joined != [] else 0
+        nhidden = len(bg[0][0]) + len(bg[0][1]) if bg != [] else 0
         nshelved = len(shelved)
         nadmit = len(given_up)
 
@@ -523,7 +639,10 @@ class Coqtail(object):
 
         # When a subgoal is finished
         if ngoals == 0:
-            next_goal = next((bgs[0] for bgs in bg_joined if bgs != []), None)
+            next_goal = next(
+                (pre[0] if pre != [] else post[0] for pre, post in bg if pre or post),
+                None,
+            )
             if next_goal is not None:
                 bullet = self.next_bullet(opts=opts)
                 bullet_info = ""
@@ -546,6 +665,7 @@ class Coqtail(object):
             else:
                 lines.append("All goals completed.")
 
+        hbar_fmt = "=" * 25 + " ({} / {})"
         for idx, goal in enumerate(fg):
             if idx == 0:
                 # Print the environment only for the current goal
@@ -554,8 +674,7 @@ class Coqtail(object):
                     lines += ls
                     highlights += hls
 
-            hbar = "{:=>25} ({} / {})".format("", idx + 1, ngoals)
-            lines += ["", hbar, ""]
+            lines += ["", hbar_fmt.format(idx + 1, ngoals), ""]
 
             ls, hls = lines_and_highlights(goal.ccl, len(lines))
             lines += ls
@@ -568,7 +687,7 @@ class Coqtail(object):
         """Update the goal message."""
         if msg is not None:
             self.goal_msg, self.goal_hls = msg
-        if clear or "".join(self.goal_msg) == "":
+        if clear or not any(self.goal_msg):
             self.goal_msg, self.goal_hls = ["No goals."], []
 
     def set_info(self, msg=None, reset=True):
@@ -597,12 +716,12 @@ class Coqtail(object):
             "coqtail_error": None,
         }  # type: Dict[str, Optional[str]]
 
-        if self.endpoints != []:
+        if self.endpoints:
             line, col = self.endpoints[-1]
             matches["coqtail_checked"] = matcher[: line + 1, :col]
 
         if self.send_queue:
-            sline, scol = self.endpoints[-1] if self.endpoints != [] else (0, -1)
+            sline, scol = self.endpoints[-1] if self.endpoints else (0, -1)
             eline, ecol = self.send_queue[-1]["stop"]
             matches["coqtail_sent"] = matcher[sline : eline + 1, scol:ecol]
 
@@ -625,25 +744,9 @@ class Coqtail(object):
     def splash(self, version, width, height, deprecated, opts):
         # type: (Text, int, int, bool, Mapping[str, Any]) -> None
         """Display the logo in the info panel."""
-        msg = [
-            u"~~~~~~~~~~~~~~~~~~~~~~~",
-            u"λ                     /",
-            u" λ      Coqtail      / ",
-            u"  λ                 /  ",
-            u"   λ{}/    ".format(("Coq " + version).center(15)),
-            u"    λ             /    ",
-            u"     λ           /     ",
-            u"      λ         /      ",
-            u"       λ       /       ",
-            u"        λ     /        ",
-            u"         λ   /         ",
-            u"          λ /          ",
-            u"           ‖           ",
-            u"           ‖           ",
-            u"           ‖           ",
-            u"          / λ          ",
-            u"         /___λ         ",
-        ]
+        version = ("Coq " + version).center(15)
+        msg = [line.format(version) for line in _SPLASH]
+        # N.B. The logo's width depends on 'version' so it isn't precomputed
         msg_maxw = max(len(line) for line in msg)
         msg = [line.center(width - msg_maxw // 2) for line in msg]
 
@@ -670,12 +773,6 @@ class Coqtail(object):
         return None
 
     # Vim Helpers #
-    @property
-    def changedtick(self):
-        # type: () -> int
-        """The value of changedtick for this buffer."""
-        return self.handler.vimvar("changedtick")  # type: ignore
-
     @property
     def log(self):
         # type: () -> Text
@@ -691,13 +788,25 @@ class Coqtail(object):
     @property
     def buffer(self):
         # type: () -> Sequence[bytes]
-        """The contents of this buffer."""
+        """The contents of this buffer as of oldchange."""
+        # N.B. After 'sync', 'oldbuf' is a prefix of the current buffer so only
+        # the remaining lines need to be fetched.
+        if not self.oldbuf_full:
+            self.oldbuf = list(self.oldbuf) + self.buffer_lines(len(self.oldbuf))
+            self.oldbuf_full = True
+        return self.oldbuf
+
+    def buffer_lines(self, start, end=None):
+        # type: (int, Optional[int]) -> List[bytes]
+        """The contents of lines 'start' up to 'end' (exclusive, 0-indexed)
+        of this buffer.
+        """
         lines = self.handler.vimcall(
             "getbufline",
             True,
             self.handler.bnum,
-            1,
-            "$",
+            start + 1,
+            end if end is not None else "$",
         )  # type: Sequence[Text]
         return [line.encode("utf-8") for line in lines]
 
@@ -708,9 +817,6 @@ class CoqtailHandler(StreamRequestHandler):
     # Redraw rate in seconds
     refresh_rate = 0.05
 
-    # How often to check for a closed channel
-    check_close_rate = 1
-
     # Is the channel open
     closed = False
 
@@ -720,17 +826,43 @@ class CoqtailHandler(StreamRequestHandler):
     # Is the client synchronous
     sync = False
 
+    # Size of the buffer used to read messages
+    # N.B. Goal and info messages can be large so use a bigger buffer than the
+    # default to read them in fewer syscalls
+    rbufsize = 64 * 1024
+
+    # Options to set on each connection's socket
+    # N.B. Messages are small and latency-sensitive so disable Nagle's
+    # algorithm
+    socket_options = [
+        (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    ]  # type: List[Tuple[int, int, int]]
+    if hasattr(socket, "TCP_QUICKACK"):
+        socket_options.append((socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1))
+
+    def setup(self):
+        # type: () -> None
+        """Configure the connection's socket."""
+        # N.B. StreamRequestHandler is an old-style class in Python 2 so
+        # super() can't be used
+        StreamRequestHandler.setup(self)
+        for level, opt, val in self.socket_options:
+            self.connection.setsockopt(level, opt, val)
+
     def parse_msgs(self):
         # type: () -> None
         """Parse messages sent over a Vim channel."""
         while not self.closed:
             try:
                 msg = self.rfile.readline()  # type: bytes
-                msg_id, data = json.loads(msg)
+                msg_id, data = _json_loads(msg)
             # Python 2 doesn't have ConnectionError
             except (ValueError, socket.error):
-                # Check if channel closed
+                # Channel closed, wake up anything waiting for a message
                 self.closed = True
+                self.reqs.put(None)
+                for queue in list(self.resps.values()):
+                    queue.put(None)
                 break
 
             if msg_id >= 0:
@@ -740,34 +872,55 @@ class CoqtailHandler(StreamRequestHandler):
                 else:
                     self.reqs.put((msg_id, bnum, func, args))
             else:
-                # N.B. Accessing self.resps concurrently creates a race condition
-                # where defaultdict could construct a Queue twice
-                with self.resp_lk:
-                    self.resps[-msg_id].put((msg_id, data))
+                # N.B. vimeval() creates the queue before sending the request
+                # so only the handler thread ever modifies self.resps
+                queue = self.resps.get(-msg_id)
+                if queue is not None:
+                    queue.put((msg_id, data))
 
     def get_msg(self, msg_id=None):
         # type: (Optional[int]) -> Sequence[Any]
-        """Check for any pending messages from Vim."""
+        """Wait for the next message from Vim."""
+        # N.B. parse_msgs() puts None in every queue when the channel closes,
+        # so check closed only after the queue exists
         if msg_id is None:
             queue = self.reqs  # type: Queue[Any]
         else:
-            with self.resp_lk:
-                queue = self.resps[msg_id]
-        while not self.closed:
-            try:
-                return queue.get(timeout=self.check_close_rate)  # type: ignore
-            except Empty:
-                pass
-        raise EOFError
+            queue = self.resps[msg_id]
+        if self.closed:
+            raise EOFError
+        msg = queue.get()
+        if msg is None:
+            raise EOFError
+        return msg  # type: ignore[no-any-return]
 
     def handle(self):
         # type: () -> None
         """Forward requests from Vim to the appropriate Coqtail function."""
         self.coq = Coqtail(self)
         self.closed = False
-        self.reqs = Queue()  # type: Queue[Tuple[int, int, str, Mapping[str, Any]]]
-        self.resps = ddict(Queue)  # type: DefaultDict[int, Queue[Tuple[int, Any]]]
-        self.resp_lk = threading.Lock()
+        self.reqs = (
+            Queue()
+        )  # type: Queue[Optional[Tuple[int, int, str, Mapping[str, Any]]]]
+        self.resps = {}  # type: Dict[int, Queue[Optional[Tuple[int, Any]]]]
+        self.wbuf = []  # type: List[bytes]
+
+        handlers = {
+            "start": self.coq.start,
+            "stop": self.coq.stop,
+            "step": self.coq.step,
+            "rewind": self.coq.rewind,
+            "to_line": self.coq.to_line,
+            "to_top": self.coq.to_top,
+            "query": self.coq.query,
+            "endpoint": self.coq.endpoint,
+            "toggle_debug": self.coq.toggle_debug,
+            "splash": self.coq.splash,
+            "sync": self.coq.sync,
+            "find_def": self.coq.find_def,
+            "find_lib": self.coq.find_lib,
+            "refresh": self.coq.refresh,
+        }  # type: Mapping[str, Callable[..., Any]]
 
         read_thread = threading.Thread(target=self.parse_msgs)
         read_thread.daemon = True
@@ -782,27 +935,12 @@ class CoqtailHandler(StreamRequestHandler):
             except EOFError:
                 break
 
-            handler = {
-                "start": self.coq.start,
-                "stop": self.coq.stop,
-                "step": self.coq.step,
-                "rewind": self.coq.rewind,
-                "to_line": self.coq.to_line,
-                "to_top": self.coq.to_top,
-                "query": self.coq.query,
-                "endpoint": self.coq.endpoint,
-                "toggle_debug": self.coq.toggle_debug,
-                "splash": self.coq.splash,
-                "sync": self.coq.sync,
-                "find_def": self.coq.find_def,
-                "find_lib": self.coq.find_lib,
-                "refresh": self.coq.refresh,
-            }.get(func, None)
+            handler = handlers.get(func, None)
 
             try:
-                ret = handler(**args) if handler is not None else None  # type: ignore
+                ret = handler(**args) if handler is not None else None
                 msg = [self.msg_id, {"buf": self.bnum, "ret": ret}]
-                self.wfile.write(json.dumps(msg).encode("utf-8") + b"\n")
+                self.write(_encode_msg(msg))
             # Python 2 doesn't have BrokenPipeError
             except (EOFError, OSError):
                 break
@@ -815,12 +953,33 @@ class CoqtailHandler(StreamRequestHandler):
             if func == "stop":
                 break
 
-    def vimeval(self, expr, wait=True):
-        # type: (List[Any], bool) -> Any
-        """Send Vim a request."""
+    def write(self, msg, flush=True):
+        # type: (bytes, bool) -> None
+        """Send 'msg' to Vim along with any buffered messages."""
+        self.wbuf.append(msg)
+        if flush:
+            bufs, self.wbuf = self.wbuf, []
+            if hasattr(self.connection, "sendmsg"):
+                # Gather the messages into one syscall without joining them
+                sent = self.connection.sendmsg(bufs)
+                if sent < sum(len(buf) for buf in bufs):
+                    self.connection.sendall(b"".join(bufs)[sent:])
+            else:
+                # N.B. sendmsg is unavailable on Windows and in Python 2
+                self.wfile.write(b"".join(bufs))
+
+    def vimeval(self, expr, wait=True, flush=True):
+        # type: (List[Any], bool, bool) -> Any
+        """Send Vim a request.
+
+        If neither 'wait' nor 'flush' is set, the request is buffered and sent
+        along with the next message.
+        """
         if wait:
             expr += [-self.msg_id]
-        self.wfile.write(json.dumps(expr).encode("utf-8") + b"\n")
+            if self.msg_id not in self.resps:
+                self.resps[self.msg_id] = Queue()
+        self.write(_encode_msg(expr), flush=wait or flush)
 
         if wait:
             msg_id, res = self.get_msg(self.msg_id)
@@ -844,18 +1003,23 @@ class CoqtailHandler(StreamRequestHandler):
     def refresh(self, goals=True, force=True, scroll=False):
         # type: (bool, bool, bool) -> None
         """Refresh the highlighting and auxiliary panels."""
+        redraw = force
         if not force:
             cur_time = time.time()
-            force = cur_time - self.refresh_time > self.refresh_rate
+            redraw = cur_time - self.refresh_time > self.refresh_rate
             self.refresh_time = cur_time
-        if force:
-            self.vimcall(
-                "coqtail#panels#refresh",
-                self.sync,
-                self.bnum,
-                self.coq.highlights,
-                self.coq.panels(goals),
-                scroll,
+        if redraw:
+            # N.B. Unforced refreshes show progress while Coqtop is busy so
+            # they must be sent immediately, but forced ones come at the end of
+            # a command and can be sent along with the response
+            self.vimeval(
+                [
+                    "call",
+                    "coqtail#panels#refresh",
+                    (self.bnum, self.coq.highlights, self.coq.panels(goals), scroll),
+                ],
+                wait=self.sync,
+                flush=not force,
             )
 
     def interrupt(self):
@@ -863,13 +1027,17 @@ class CoqtailHandler(StreamRequestHandler):
         """Interrupt Coqtop and clear the request queue."""
         if self.working:
             self.working = False
+            replies = []  # type: List[bytes]
             while not self.reqs.empty():
                 try:
                     msg_id, bnum, _, _ = self.reqs.get_nowait()
                     msg = [msg_id, {"buf": bnum, "ret": None}]
-                    self.wfile.write(json.dumps(msg).encode("utf-8") + b"\n")
+                    replies.append(_encode_msg(msg))
                 except Empty:
                     break
+            # N.B. Don't use 'write' since this runs on the reader thread
+            if replies:
+                self.wfile.write(b"".join(replies))
             self.coq.coqtop.interrupt()
 
 
@@ -883,6 +1051,10 @@ class CoqtailServer(object):
         # type: (bool) -> int
         """Start the TCP server."""
         # N.B. port = 0 chooses any arbitrary open one
+        # N.B. Each connection is handled in its own thread (plus one to read
+        # messages) because handling a request blocks on Coqtop and on replies
+        # from Vim. The threads are idle between requests, so an event loop
+        # would save little for the handful of buffers open at once.
         CoqtailHandler.sync = sync
         CoqtailServer.serv = ThreadingTCPServer(("localhost", 0), CoqtailHandler)
         CoqtailServer.serv.daemon_threads = True
@@ -908,7 +1080,8 @@ class ChannelManager(object):
     """Emulate Vim's ch_* functions with sockets."""
 
     channels = {}  # type: Dict[int, socket.socket]
-    results = {}  # type: Dict[int, Optional[Text]]
+    results = {}  # type: Dict[int, Queue[Text]]
+    files = {}  # type: Dict[int, IO[bytes]]
     sessions = {}  # type: Dict[int, int]
     next_id = 1
     msg_id = 1
@@ -921,9 +1094,21 @@ class ChannelManager(object):
         ChannelManager.next_id += 1
 
         host, port = address.split(":")
-        ChannelManager.channels[ch_id] = socket.create_connection((host, int(port)))
+        ch = socket.create_connection((host, int(port)))
+        for level, opt, val in CoqtailHandler.socket_options:
+            ch.setsockopt(level, opt, val)
+        ChannelManager.channels[ch_id] = ch
+        bufsize = CoqtailHandler.rbufsize
+        ChannelManager.files[ch_id] = ch.makefile("rb", bufsize)  # type: ignore
+        ChannelManager.results[ch_id] = Queue()
         ChannelManager.sessions[ch_id] = -1
 
+        # N.B. A single thread receives every message on the channel rather
+        # than starting a new one per request
+        recv_thread = threading.Thread(target=ChannelManager._recv, args=(ch_id,))
+        recv_thread.daemon = True
+        recv_thread.start()
+
         return ch_id
 
     @staticmethod
@@ -931,8 +1116,17 @@ class ChannelManager(object):
         # type: (int) -> None
         """Close a channel."""
         try:
-            ChannelManager.channels[handle].close()
+            ch = ChannelManager.channels[handle]
+            # N.B. Shut down the socket first to wake the receiving thread,
+            # which otherwise holds the reader's lock and blocks close()
+            try:
+                ch.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            ChannelManager.files[handle].close()
+            ch.close()
             del ChannelManager.channels[handle]
+            del ChannelManager.files[handle]
             del ChannelManager.results[handle]
             del ChannelManager.sessions[handle]
         except KeyError:
@@ -964,85 +1158,95 @@ class ChannelManager(object):
             ChannelManager.msg_id += 1
         else:
             msg_id = reply
-        ch.sendall((json.dumps([msg_id, expr]) + "\n").encode("utf-8"))
-
-        if returns:
-            ChannelManager.results[handle] = None
-            recv_thread = threading.Thread(target=ChannelManager._recv, args=(handle,))
-            recv_thread.daemon = True
-            recv_thread.start()
+        ch.sendall(_encode_msg([msg_id, expr]))
         return True
 
     @staticmethod
     def poll(handle):
         # type: (int) -> Optional[Text]
         """Wait for a response on a channel."""
-        return ChannelManager.results[handle]
+        try:
+            return ChannelManager.results[handle].get_nowait()  # type: ignore[no-any-return]
+        except (KeyError, Empty):
+            return None
 
     @staticmethod
     def _recv(handle):
         # type: (int) -> None
-        """Wait for a response on a channel."""
-        data = []
+        """Receive responses on a channel until it is closed."""
+        try:
+            rfile = ChannelManager.files[handle]
+            results = ChannelManager.results[handle]
+        except KeyError:
+            return
+
         while True:
+            # N.B. Messages are newline-terminated so the buffered reader can
+            # find the end of one without trying to parse it
             try:
-                data.append(ChannelManager.channels[handle].recv(4096).decode("utf-8"))
-                # N.B. Some older Vims can't convert expressions with None
-                # to Vim values so just return a string
-                res = "".join(data)
-                _ = json.loads(res)
-                ChannelManager.results[handle] = res
+                msg = rfile.readline()
+            # Python 2 doesn't have ConnectionError
+            except (ValueError, socket.error):
+                # The channel was closed
                 break
-            # Python 2 doesn't have json.JSONDecodeError
-            except ValueError:
-                pass
-            except KeyError:
+            if msg == b"":
                 break
 
+            # N.B. Some older Vims can't convert expressions with None to Vim
+            # values so just return a string
+            results.put(msg.rstrip(b"\n").decode("utf-8"))
+
 
 # Searching for Coq Definitions #
+# Implicitly generated names and the type of object that generates them
+_AUTO_NAMES = (
+    ("Constructor", "Inductive", re.compile("Build_(.*)"), 1),
+    ("Constant", "Inductive", re.compile("(.*)_(ind|rect?)"), 1),
+)
+
+# The Vernacular commands that define each type of object
+_TYPE_TO_VERNACS = {
+    "Inductive": ["(Co)?Inductive", "Variant", "Class", "Record"],
+    "Constant": [
+        "Definition",
+        "Let",
+        "(Co)?Fixpoint",
+        "Function",
+        "Instance",
+        "Theorem",
+        "Lemma",
+        "Remark",
+        "Fact",
+        "Corollary",
+        "Proposition",
+        "Example",
+        "Parameters?",
+        "Axioms?",
+        "Conjectures?",
+    ],
+    "Notation": ["Notation"],
+    "Variable": ["Variables?", "Hypothes[ie]s", "Context"],
+    "Ltac": ["Ltac"],
+    "Module": ["Module"],
+    "Module Type": ["Module Type"],
+}  # type: Mapping[Text, List[Text]]
+_TYPE_TO_VERNAC = {
+    typ: "|".join(vernacs) for typ, vernacs in _TYPE_TO_VERNACS.items()
+}  # type: Mapping[Text, Text]
+
+
 # TODO: could search more intelligently by searching only within relevant
 # section/module, or sometimes by looking at the type (for constructors for
 # example, or record projections)
 def get_searches(tgt_type, tgt_name):
     # type: (Text, Text) -> List[Text]
     """Construct a search expression given an object type and name."""
-    auto_names = [
-        ("Constructor", "Inductive", "Build_(.*)", 1),
-        ("Constant", "Inductive", "(.*)_(ind|rect?)", 1),
-    ]
-    type_to_vernac = {
-        "Inductive": ["(Co)?Inductive", "Variant", "Class", "Record"],
-        "Constant": [
-            "Definition",
-            "Let",
-            "(Co)?Fixpoint",
-            "Function",
-            "Instance",
-            "Theorem",
-            "Lemma",
-            "Remark",
-            "Fact",
-            "Corollary",
-            "Proposition",
-            "Example",
-            "Parameters?",
-            "Axioms?",
-            "Conjectures?",
-        ],
-        "Notation": ["Notation"],
-        "Variable": ["Variables?", "Hypothes[ie]s", "Context"],
-        "Ltac": ["Ltac"],
-        "Module": ["Module"],
-        "Module Type": ["Module Type"],
-    }  # type: Mapping[Text, List[Text]]
-
     # Look for some implicitly generated names
     search_names = [tgt_name]
     search_types = [tgt_type]
-    for from_type, to_type, pat, grp in auto_names:
+    for from_type, to_type, pat, grp in _AUTO_NAMES:
         if tgt_type == from_type:
-            match = re.match(pat, tgt_name)
+            match = pat.match(tgt_name)
             if match is not None:
                 search_names.append(match.group(grp))
                 search_types.append(to_type)
@@ -1050,7 +1254,7 @@ def get_searches(tgt_type, tgt_name):
 
     # What Vernacular command to look for
     search_vernac = "|".join(
-        vernac for typ in search_types for vernac in type_to_vernac.get(typ, [])
+        _TYPE_TO_VERNAC[typ] for typ in search_types if typ in _TYPE_TO_VERNAC
     )
 
     return [
@@ -1064,7 +1268,11 @@ def _adjust_offset(start, end, com_pos):
     # type: (int, int, List[List[int]]) -> Tuple[int, int]
     """Adjust offsets by taking the stripped comments into account."""
     # Move start and end forward by the length of the preceding comments
+    # N.B. Comments are sorted and don't overlap, so none of the remaining
+    # comments can precede either offset once one starts after both
     for coff, clen in com_pos:
+        if start < coff and end < coff:
+            break
         if coff <= start:
             # N.B. Subtract one because comments are replaced by " ", not ""
             start += clen - 1
@@ -1077,11 +1285,9 @@ def _adjust_offset(start, end, com_pos):
 def _pos_from_offset(col, msg, offset):
     # type: (int, bytes, int) -> Tuple[int, int]
     """Calculate the line and column of a given offset."""
-    msg = msg[:offset]
-    lines = msg.split(b"\n")
-
-    line = len(lines) - 1
-    col = len(lines[-1]) + (col if line == 0 else 0)
+    offset = min(offset, len(msg))
+    line = msg.count(b"\n", 0, offset)
+    col = offset - (msg.rfind(b"\n", 0, offset) + 1) + (col if line == 0 else 0)
 
     return (line, col)
 
@@ -1092,12 +1298,13 @@ def _between(buf, start, end):
     sline, scol = start
     eline, ecol = end
 
-    lines = []  # type: List[bytes]
-    for idx, line in enumerate(buf[sline : eline + 1]):
-        lcol = scol if idx == 0 else 0
-        rcol = ecol + 1 if idx == eline - sline else len(line)
-        lines.append(line[lcol:rcol])
+    if sline == eline:
+        return buf[sline][scol : ecol + 1]
 
+    # Only the first and last lines need to be trimmed
+    lines = [buf[sline][scol:]]
+    lines.extend(buf[sline + 1 : eline])
+    lines.append(buf[eline][: ecol + 1])
     return b"\n".join(lines)
 
 
@@ -1111,8 +1318,6 @@ def _get_message_range(lines, after):
 def _find_next_sentence(lines, sline, scol):
     # type: (Sequence[bytes], int, int) -> Tuple[int, int]
     """Find the next sentence to send to Coq."""
-    bullets = (ord("{"), ord("}"), ord("-"), ord("+"), ord("*"))
-
     line, col = (sline, scol)
     while True:
         # Skip leading whitespace
@@ -1143,43 +1348,21 @@ def _find_next_sentence(lines, sline, scol):
         else:
             break
 
+    # N.B. Slicing gives bytes in both Python 2 and 3
+    bullet = first_line[:1]
+
     # Check if the first character of the sentence is a bullet
-    if indexbytes(first_line, 0) in bullets:  # type: ignore[no-untyped-call]
+    if bullet in (b"{", b"}"):
+        return (line, col)
+    if bullet in (b"-", b"+", b"*"):
         # '-', '+', '*' can be repeated
-        for c in iterbytes(first_line[1:]):
-            if c in bullets[2:] and c == indexbytes(first_line, 0):  # type: ignore[no-untyped-call]
-                col += 1
-            else:
-                break
+        col += len(first_line) - len(first_line.lstrip(bullet)) - 1
         return (line, col)
 
     # Check if this is a bracketed goal selector
-    if _char_isdigit(indexbytes(first_line, 0)):  # type: ignore[no-untyped-call]
-        state = "digit"
-        selcol = col
-        for c in iterbytes(first_line[1:]):
-            # Hack to silence mypy complaints in Python 2
-            assert isinstance(c, int)
-            if state == "digit" and _char_isdigit(c):
-                selcol += 1
-            elif state == "digit" and _char_isspace(c):
-                state = "beforecolon"
-                selcol += 1
-            elif state == "digit" and c == ord(":"):
-                state = "aftercolon"
-                selcol += 1
-            elif state == "beforecolon" and _char_isspace(c):
-                selcol += 1
-            elif state == "beforecolon" and c == ord(":"):
-                state = "aftercolon"
-                selcol += 1
-            elif state == "aftercolon" and _char_isspace(c):
-                selcol += 1
-            elif state == "aftercolon" and c == ord("{"):
-                selcol += 1
-                return (line, selcol)
-            else:
-                break
+    selector = _SELECTOR_RE.match(first_line)
+    if selector is not None:
+        return (line, col + selector.end() - 1)
 
     # Otherwise, find an ending '.'
     return _find_dot_after(lines, line, col)
@@ -1191,41 +1374,35 @@ def _find_dot_after(lines, sline, scol):
     max_line = len(lines)
 
     while sline < max_line:
-        line = lines[sline][scol:]
-        dot_pos = line.find(b".")
-        com_pos = line.find(b"(*")
-        str_pos = line.find(b'"')
-
-        if dot_pos == -1 and com_pos == -1 and str_pos == -1:
-            # Nothing on this line
-            sline += 1
-            scol = 0
-        elif dot_pos == -1 or (0 <= com_pos < dot_pos) or (0 <= str_pos < dot_pos):
-            if str_pos == -1 or (0 <= com_pos < str_pos):
+        line = lines[sline]
+        for match in _DOT_RE.finditer(line, scol):
+            tok, pos = match.group(), match.start()
+            if tok == b"(*":
                 # We see a comment opening before the next '.'
-                com_end = _skip_comment(lines, sline, scol + com_pos)
+                com_end = _skip_comment(lines, sline, pos)
                 if com_end is None:
-                    raise UnmatchedError("(*", (sline, scol + com_pos))
+                    raise UnmatchedError("(*", (sline, pos))
 
                 sline, scol = com_end
-            else:
+                break
+            elif tok == b'"':
                 # We see a string starting before the next '.'
-                str_end = _skip_str(lines, sline, scol + str_pos)
+                str_end = _skip_str(lines, sline, pos)
                 if str_end is None:
-                    raise UnmatchedError('"', (sline, scol + str_pos))
+                    raise UnmatchedError('"', (sline, pos))
 
                 sline, scol = str_end
-        elif line[dot_pos : dot_pos + 2] in (b".", b". "):
-            # Don't stop for '.' used in qualified name or for '..'
-            return (sline, scol + dot_pos)
-        elif line[dot_pos : dot_pos + 3] == b"...":
-            # But do allow '...'
-            return (sline, scol + dot_pos + 2)
-        elif line[dot_pos : dot_pos + 2] == b"..":
-            # Skip second '.'
-            scol += dot_pos + 2
+                break
+            elif tok == b"...":
+                # Allow '...'
+                return (sline, pos + 2)
+            elif tok == b"." and line[pos + 1 : pos + 2] in (b"", b" "):
+                # Don't stop for '.' used in qualified name or for '..'
+                return (sline, pos)
         else:
-            scol += dot_pos + 1
+            # Nothing else on this line
+            sline += 1
+            scol = 0
 
     raise NoDotError()
 
@@ -1265,50 +1442,65 @@ def _skip_block(
     if skips is None:
         skips = {}
 
+    block_re = _block_re(sstr, estr, skips)
+
     while nesting > 0:
         if sline >= max_line:
             return None
 
-        line = lines[sline]
-        blk_end = line.find(estr, scol)  # type: Optional[int]
-        blk_end = blk_end if blk_end != -1 else None
-        if sstr != estr:
-            blk_start = line.find(sstr, scol, blk_end)  # type: Optional[int]
-            blk_start = blk_start if blk_start != -1 else None
-        else:
-            blk_start = None
-        assert blk_start is None or blk_end is None or blk_start < blk_end
-
-        # Look for contained blocks to skip
-        skip_stop = blk_start if blk_start is not None else blk_end
-        skip_starts = [(line.find(skip, scol, skip_stop), skip) for skip in skips]
-        skip_starts = [(start, skip) for start, skip in skip_starts if start != -1]
-        # TODO: use default= in Python 3
-        skip_start, skip = min(skip_starts) if skip_starts != [] else (None, None)
-        if skip is not None and skip_start is not None:
-            skip_end = skips[skip](lines, sline, skip_start)
-            if skip_end is None:
-                return None
-
-            sline, scol = skip_end
+        match = block_re.search(lines[sline], scol)
+        if match is None:
+            # Nothing on this line
+            sline += 1
+            scol = 0
             continue
 
-        if blk_end is not None and blk_start is None:
-            # Found an end and no new start
-            scol = blk_end + len(estr)
+        tok = match.group()
+        if tok == estr:
+            # Found an end
+            scol = match.end()
             nesting -= 1
-        elif blk_start is not None:
+        elif tok == sstr:
             # Found a new start
-            scol = blk_start + len(sstr)
+            scol = match.end()
             nesting += 1
         else:
-            # Nothing on this line
-            sline += 1
-            scol = 0
+            # Found a contained block to skip
+            skip_end = skips[tok](lines, sline, match.start())
+            if skip_end is None:
+                return None
+
+            sline, scol = skip_end
 
     return (sline, scol)
 
 
+_block_res = {}  # type: Dict[Tuple[bytes, bytes, Tuple[bytes, ...]], Pattern[bytes]]
+
+
+def _block_re(sstr, estr, skips):
+    # type: (bytes, bytes, Iterable[bytes]) -> Pattern[bytes]
+    """Compile a regex matching the delimiters that _skip_block looks for."""
+    key = (sstr, estr, tuple(sorted(skips)))
+    try:
+        return _block_res[key]
+    except KeyError:
+        pass
+
+    toks = [re.escape(estr)]
+    if sstr != estr:
+        # N.B. A start that overlaps the following end (e.g. '(*)') is treated
+        # as an end
+        overlaps = b"".join(
+            b"(?!" + b"." * n + re.escape(estr) + b")" for n in range(1, len(sstr))
+        )
+        toks.append(overlaps + re.escape(sstr))
+    toks += [re.escape(skip) for skip in key[2]]
+
+    block_re = _block_res[key] = re.compile(b"|".join(toks))
+    return block_re
+
+
 # Region Highlighting #
 class Matcher(object):
     """Construct Vim regexes to pass to 'matchadd()' for an arbitrary region."""
@@ -1386,33 +1578,35 @@ def _strip_comments(msg):
     # N.B. Coqtop will ignore comments, but it makes it easier to inspect
     # commands in Coqtail (e.g. options in coqtop.do_option) if we remove
     # them.
+    if b"(*" not in msg:
+        # Fast path for the common case of a sentence without comments
+        return msg, []
+
     nocom = []
     com_pos = []  # Remember comment offset and length
-    off = 0
+    off = 0  # The end of the last comment delimiter
     nesting = 0
 
-    while msg != b"":
-        start = msg.find(b"(*")
-        end = msg.find(b"*)")
-        if start == -1 and (end == -1 or (end != -1 and nesting == 0)):
-            # No comments left
-            nocom.append(msg)
-            break
-        elif start != -1 and (start < end or end == -1):
+    for match in _COMMENT_RE.finditer(msg):
+        start, end = match.span()
+        if match.group() == b"(*":
             # New nested comment
             if nesting == 0:
-                nocom.append(msg[:start])
-                com_pos.append([off + start, 0])
-            msg = msg[start + 2 :]
-            off += start + 2
+                nocom.append(msg[off:start])
+                com_pos.append([start, 0])
             nesting += 1
-        elif end != -1 and (end < start or start == -1):
+        elif nesting == 0 and msg.find(b"(*", end) == -1:
+            # No comments left
+            break
+        else:
             # End of a comment
-            msg = msg[end + 2 :]
-            off += end + 2
             nesting -= 1
             if nesting == 0:
-                com_pos[-1][1] = off - com_pos[-1][0]
+                com_pos[-1][1] = end - com_pos[-1][0]
+        off = end
+
+    if off < len(msg):
+        nocom.append(msg[off:])
 
     return b" ".join(nocom), com_pos
 
@@ -1420,17 +1614,59 @@ def _strip_comments(msg):
 def _find_diff(x, y, stop=None):
     # type: (Sequence[Any], Sequence[Any], Optional[int]) -> Optional[int]
     """Locate the first differing element in 'x' and 'y' up to 'stop'."""
-    seq = enumerate(zip_longest(x, y))  # type: Iterator[Tuple[int, Any]]
+    # N.B. Compare slices instead of individual elements so the comparisons
+    # happen in C. First find a chunk containing the difference by doubling
+    # the chunk size, then binary search within it.
+    end = min(len(x), len(y))
     if stop is not None:
-        seq = islice(seq, stop)
-    return next((i for i, vs in seq if vs[0] != vs[1]), None)
+        end = min(end, stop)
 
+    # Fast path for identical sequences, compared without copying
+    if len(x) == len(y) == end and x == y:
+        return None
 
-def _char_isdigit(c):
-    # type: (int) -> bool
-    return ord("0") <= c <= ord("9")
-
+    start, size = 0, 1
+    while start < end:
+        chunk_end = min(start + size, end)
+        if x[start:chunk_end] != y[start:chunk_end]:
+            break
+        start, size = chunk_end, size * 2
+    else:
+        # The shorter sequence is a prefix of the longer one
+        if len(x) != len(y) and (stop is None or end < stop):
+            return end
+        return None
 
-def _char_isspace(c):
-    # type: (int) -> bool
-    return c in iterbytes(b" \t\n\r\x0b\f")  # type: ignore[operator]
+    while chunk_end - start > 1:
+        mid = (start + chunk_end) // 2
+        if x[start:mid] != y[start:mid]:
+            chunk_end = mid
+        else:
+            start = mid
+    return start
+
+
+def _json_dumps(obj):
+    # type: (Any) -> bytes
+    """Encode 'obj' as compact JSON."""
+    if _HAS_ORJSON:
+        # N.B. Annotate the result since orjson is untyped when not installed
+        data = orjson.dumps(obj)  # type: bytes
+        return data
+    return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+
+def _json_loads(data):
+    # type: (bytes) -> Any
+    """Decode the JSON in 'data'."""
+    if _HAS_ORJSON:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _encode_msg(msg):
+    # type: (Any) -> bytes
+    """Encode 'msg' as a single line of compact JSON."""
+    # N.B. Vim channels only understand newline-delimited JSON, so the savings
+    # come from dropping the whitespace json.dumps inserts by default.
+    return _json_dumps(msg) + b"\n"
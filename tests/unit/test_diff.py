@@ -0,0 +1,39 @@
+# -*- coding: utf8 -*-
+# Author: Wolf Honore
+"""Buffer diffing unit tests."""
+
+from __future__ import absolute_import, division, print_function
+
+import pytest
+
+from coqtail import _find_diff
+
+# Test Values #
+diff_tests = (
+    ("empty", [], [], None, None),
+    ("same", [b"a", b"b"], [b"a", b"b"], None, None),
+    ("first", [b"a", b"b"], [b"c", b"b"], None, 0),
+    ("last", [b"a", b"b", b"c"], [b"a", b"b", b"d"], None, 2),
+    ("multiple", [b"a", b"b", b"c"], [b"a", b"d", b"e"], None, 1),
+    ("shorter", [b"a", b"b"], [b"a"], None, 1),
+    ("longer", [b"a"], [b"a", b"b"], None, 1),
+    ("empty longer", [], [b"a"], None, 0),
+    ("before stop", [b"a", b"b"], [b"a", b"c"], 2, 1),
+    ("after stop", [b"a", b"b"], [b"a", b"c"], 1, None),
+    ("stop zero", [b"a"], [b"b"], 0, None),
+    ("shorter before stop", [b"a", b"b"], [b"a"], 2, 1),
+    ("shorter at stop", [b"a", b"b"], [b"a"], 1, None),
+    ("bytes", b"abcd", b"abed", None, 2),
+    ("bytes stop", b"abcd", b"abed", 2, None),
+    ("large", [b"a"] * 5000 + [b"b"], [b"a"] * 5000 + [b"c"], None, 5000),
+    ("large same", [b"a"] * 5000, [b"a"] * 5000, None, None),
+    ("large same stop", [b"a"] * 5000, [b"a"] * 5000, 100, None),
+    ("large shorter", [b"a"] * 5000, [b"a"] * 4999, None, 4999),
+)
+
+
+# Test Cases #
+@pytest.mark.parametrize("_name, x, y, stop, expected", diff_tests)
+def test_find_diff(_name, x, y, stop, expected):
+    """_find_diff() should find the first difference before 'stop'."""
+    assert _find_diff(x, y, stop) == expected
@@ -6,7 +6,13 @@ from __future__ import absolute_import, division, print_function
 
 import pytest
 
-from coqtail import NoDotError, UnmatchedError, _get_message_range, _strip_comments
+from coqtail import (
+    NoDotError,
+    UnmatchedError,
+    _adjust_offset,
+    _get_message_range,
+    _strip_comments,
+)
 
 # Test Values #
 tests = (
@@ -19,6 +25,7 @@ tests = (
     ("comment mid", ["A (* c. *) B."], (0, 12)),
     ("comment post", ["A (* c. *)."], (0, 10)),
     ("comment nest", ["A (* (* c. *) *)."], (0, 16)),
+    ("comment star paren", ["A (* (*) B."], (0, 10)),
     ("str", ['A "B.".'], (0, 6)),
     ("str nest", ['A """B.""".'], (0, 10)),
     ("qualified", ["A.B."], (0, 3)),
@@ -33,10 +40,14 @@ tests = (
     ("bullet --", ["-- A."], (0, 1)),
     ("bullet ++", ["++ A."], (0, 1)),
     ("bullet **", ["** A."], (0, 1)),
+    ("bullet -+", ["-+ A."], (0, 0)),
+    ("bullet --- indented", ["  --- A."], (0, 4)),
     ("bullet {", ["{ A. }"], (0, 0)),
     ("bullet {{", ["{{ A. }}"], (0, 0)),
     ("bullet {{ 2", ["{{ A. }}"], (0, 1), (0, 1)),
     ("dot3", ["A..."], (0, 3)),
+    ("dot2 then dot", ["A.. B."], (0, 5)),
+    ("dot tab", ["A.\tB."], (0, 4)),
     ("large space", ("A" + ("\n" * 5000) + ".").split("\n"), (5000, 0)),
     ("large comment", ("(*" + ("\n" * 5000) + "*) A.").split("\n"), (5000, 4)),
     ("attribute word", ["#[A] B."], (0, 6)),
@@ -64,6 +75,7 @@ tests = (
     ("focus space before colon", ["1 :{"], (0, 3)),
     ("focus trailing command no spaces", ["2:{t."], (0, 2)),
     ("focus trailing command with spaces", ["2 : { t."], (0, 4)),
+    ("focus multiple digits", ["12 : {"], (0, 5)),
     # Invalid tests
     ("no dot", ["A"], (NoDotError, None)),
     ("dot2", ["A.."], (NoDotError, None)),
@@ -137,3 +149,18 @@ com_tests = (
 def test_strip_comment(_name, msg, expected):
     """_strip_comments() should remove only comments"""
     assert _strip_comments(msg) == expected
+
+
+adjust_tests = (
+    ("no comment", (0, 3), [], (0, 3)),
+    ("before comments", (0, 3), [[4, 10], [20, 9]], (0, 3)),
+    ("between comments", (7, 10), [[4, 10], [20, 9]], (16, 19)),
+    ("after comments", (13, 14), [[4, 10], [20, 9]], (30, 31)),
+    ("spanning comment", (0, 10), [[4, 10], [20, 9]], (0, 19)),
+)
+
+
+@pytest.mark.parametrize("_name, offsets, com_pos, expected", adjust_tests)
+def test_adjust_offset(_name, offsets, com_pos, expected):
+    """_adjust_offset() should skip over the stripped comments"""
+    assert _adjust_offset(offsets[0], offsets[1], com_pos) == expected